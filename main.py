@@ -46,7 +46,6 @@ if __name__ == "__main__":
     model.load_state_dict(torch.load("result/models/super_resolution.pt"))
 
     optimizer = torch.optim.AdamW(model.parameters(), lr=3e-5)
-    scaler = torch.cuda.amp.GradScaler()
 
     print(f"Number of parameters: {sum(param.numel() for param in model.parameters())}")
 
@@ -60,7 +59,7 @@ if __name__ == "__main__":
 
         inputs = torch.stack([util.tensor.resize_and_crop(inputs, H, W)])
 
-        with torch.cuda.amp.autocast():
+        with torch.autocast("cuda", dtype=torch.bfloat16):
             with torch.no_grad():
                 output = model(inputs)
 
@@ -79,7 +78,7 @@ if __name__ == "__main__":
 
         inputs_lr = util.tensor.random_downsample(1/4)(inputs)
 
-        with torch.cuda.amp.autocast():
+        with torch.autocast("cuda", dtype=torch.bfloat16):
             edge_map = (
                 F.conv2d(inputs, weight=gx, padding=1,groups=3) ** 2 +
                 F.conv2d(inputs, weight=gy, padding=1,groups=3) ** 2
@@ -88,9 +87,9 @@ if __name__ == "__main__":
             output = model(inputs_lr)
             loss = (torch.abs(output - inputs) * edge_map.detach()).sum() / edge_map.sum()
 
-        scaler.scale(loss).backward()
-        scaler.step(optimizer)
-        scaler.update()
+        # bf16 has the range of fp32, so no loss scaling is needed
+        loss.backward()
+        optimizer.step()
         optimizer.zero_grad()
 
         print(f"\r#{i:<6d} - loss: {loss.item():8.4f}",end="")
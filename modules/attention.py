@@ -1,27 +1,37 @@
+import warnings
+
 import torch
 import torch.nn.functional as F
 from torch import Tensor, nn
 
+from .norm import RMSNorm
+
+try:
+    from .flash_window_attn import sdpa_window
+    from .fused_norm import residual_layer_norm, residual_rms_norm
+except ImportError:
+    # Triton is optional, use the built-in kernels without it
+    sdpa_window = F.scaled_dot_product_attention
+    residual_layer_norm = None
+    residual_rms_norm = None
 
-def window_partition(x: Tensor, window_size: int) -> Tensor:
-    """Partitions (B, C, H, W) into (B, num_windows, C, `window_size`, `window_size`)"""
+def window_tokens(x: Tensor, window_size: int) -> Tensor:
+    """Partitions (B, C, H, W) into (B, num_windows, `window_size` * `window_size`, C)"""
     B, C, H, W = x.shape
-    num_windows = H * W // window_size ** 2
     return (
         x.reshape(B, C, H // window_size, window_size, W // window_size, window_size)
-         .permute(0, 1, 2, 4, 3, 5)
-         .reshape(B, C, num_windows, window_size, window_size)
-         .permute(0, 2, 1, 3, 4)
+         .permute(0, 2, 4, 3, 5, 1)
+         .reshape(B, -1, window_size ** 2, C)
     )
 
-def window_unpartition(x: Tensor, H: int, W: int) -> Tensor:
-    """Unpartitions (B, num_windows, C, `window_size`, `window_size`) into (B, C, H, W)"""
-    B, _, C, window_size, _ = x.shape
+def window_untokens(x: Tensor, H: int, W: int, window_size: int) -> Tensor:
+    """Unpartitions (B, num_windows, `window_size` * `window_size`, C) into channels last (B, C, H, W)"""
+    B, _, _, C = x.shape
     return (
-        x.permute(0, 2, 1, 3, 4)
-         .reshape(B, C, H // window_size, W // window_size, window_size, window_size)
-         .permute(0, 1, 2, 4, 3, 5)
-         .reshape(B, C, H, W)
+        x.reshape(B, H // window_size, W // window_size, window_size, window_size, C)
+         .transpose(2, 3)
+         .reshape(B, H, W, C)
+         .permute(0, 3, 1, 2)
     )
 
 def spatial_flatten(x: Tensor) -> Tensor:
@@ -40,71 +50,96 @@ class MultiHeadAttention(nn.Module):
     - Output: (*, L, `dim`)
     """
 
-    def __init__(self, dim: int, transposed: bool, num_heads: int = 8) -> None:
+    def __init__(
+        self,
+        dim: int,
+        transposed: bool,
+        num_heads: int = 8,
+        shared: "MultiHeadAttention | None" = None
+    ) -> None:
         """
         Parameters:
         - `dim`: number of channels
         - `transposed`: if `True`, computes `(qT x k x vT)T` instead of `q x kT x v`
         - `num_heads`: number of attention heads
+        - `shared`: if given, reuses its qkv and output projections instead of creating new ones
         """
 
         super().__init__()
         self.dim = dim
         self.transposed = transposed
         self.num_heads = num_heads
-        self.project_q = nn.Linear(dim, dim)
-        self.project_k = nn.Linear(dim, dim)
-        self.project_v = nn.Linear(dim, dim)
-        self.project_out = nn.Linear(dim, dim)
+        # Opt-in Triton kernel for the window branch, see `enable_fused_window_attention`
+        self.fused_window_attention = False
+        if shared is None:
+            self.project_qkv = nn.Linear(dim, dim * 3)
+            self.project_out = nn.Linear(dim, dim)
+        else:
+            self.project_qkv = shared.project_qkv
+            self.project_out = shared.project_out
+
+    # Version 2 packs `project_q`, `project_k` and `project_v` into `project_qkv`
+    _version = 2
+
+    def _load_from_state_dict(self, state_dict: dict, prefix: str, local_metadata: dict, *args) -> None:
+        version = local_metadata.get("version", None)
+        if (version is None or version < 2) and f"{prefix}project_q.weight" in state_dict:
+            for name in ("weight", "bias"):
+                state_dict[f"{prefix}project_qkv.{name}"] = torch.cat([
+                    state_dict.pop(f"{prefix}project_{x}.{name}") for x in "qkv"
+                ])
+
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, *args)
     
     def forward(self, q: Tensor, k: Tensor, v: Tensor) -> Tensor:
-        L, C = q.shape[-2], q.shape[-1]
+        batch_shape, L, C = q.shape[:-2], q.shape[-2], q.shape[-1]
         head_dim = C // self.num_heads
 
-        q = (
-            self.project_q(q)
-            .unflatten(-1, (self.num_heads, head_dim))
-            .transpose(-2, -3)
-        )
-        k = (
-            self.project_k(k)
-            .unflatten(-1, (self.num_heads, head_dim))
-            .transpose(-2, -3)
-        )
-        v = (
-            self.project_v(v)
-            .unflatten(-1, (self.num_heads, head_dim))
-            .transpose(-2, -3)
-        )
+        if q is k and k is v:
+            # Self attention, q, k and v come from a single packed GEMM,
+            # chunking its last dim afterwards is a free view
+            q, k, v = self.project_qkv(q).chunk(3, -1)
+        else:
+            q, k, v = [
+                F.linear(x, weight, bias)
+                for x, weight, bias in zip(
+                    (q, k, v),
+                    self.project_qkv.weight.chunk(3),
+                    self.project_qkv.bias.chunk(3)
+                )
+            ]
+
+        # Merge all leading dims into one batch dim, so every GEMM below
+        # sees (B * N, num_heads) batches, restored only after the output projection
+        q, k, v = [
+            x.reshape(-1, *x.shape[-2:]).unflatten(-1, (self.num_heads, head_dim))
+            for x in (q, k, v)
+        ]
 
         if self.transposed:
+            # q and v are viewed as (B * N, num_heads, head_dim, L) and k as (B * N, num_heads, L, head_dim),
+            # one `1 / L` goes on q, the other on the small (head_dim, head_dim) scores after the fp32 upcast,
+            # a single `1 / L ** 2` on q would underflow half precision q to zero at large L
+            scores = torch.matmul(q.movedim(-3, -1) / L, k.transpose(-2, -3))
             x = torch.matmul(
-                F.softmax(
-                    torch.matmul(
-                        q.transpose(-2, -1) / L,
-                        k / L
-                    ),
-                    -1
-                ),
-                v.transpose(-2, -1)
-            ).transpose(-1, -3).transpose(-1, -2)
-        else: 
-            x = torch.matmul(
-                F.softmax(
-                    torch.matmul(
-                        q / head_dim,
-                        k.transpose(-2, -1) / head_dim
-                    ),
-                    -1
-                ),
-                v
+                F.softmax(scores.float() / L, -1).to(v.dtype),
+                v.movedim(-3, -1)
+            ).movedim(-1, -3)
+        else:
+            # Scale matches the original `(q / head_dim) x (k / head_dim)T`
+            attention = sdpa_window if self.fused_window_attention else F.scaled_dot_product_attention
+            x = attention(
+                q.transpose(-2, -3),
+                k.transpose(-2, -3),
+                v.transpose(-2, -3),
+                scale=1 / head_dim ** 2
             ).transpose(-2, -3)
         
         x = self.project_out(
             x.flatten(-2)
         )
 
-        return x
+        return x.reshape(*batch_shape, L, C)
     
 class AttentionBlock(nn.Module):
     """
@@ -113,50 +148,155 @@ class AttentionBlock(nn.Module):
     - Output: (B, N, `dim`)
     """
 
-    def __init__(self, dim: int, transposed: bool, window_size: int = 8, num_heads: int = 8) -> None:
+    def __init__(
+        self,
+        dim: int,
+        transposed: bool,
+        window_size: int = 8,
+        num_heads: int = 8,
+        shared: "AttentionBlock | None" = None,
+        rms_norm: bool = False
+    ) -> None:
         """
         Parameters:
         - `dim`: number of channels
         - `transposed`: if `True`, computes `(qT x k x vT)T` instead of `q x kT x v`
         - `window_size`: size of square window
         - `num_heads`: number of attention heads
+        - `shared`: if given, reuses the attention projections of this block
+        - `rms_norm`: if `True`, uses `RMSNorm` instead of `nn.LayerNorm` (default False)
         """
 
         super().__init__()
         self.window_size = window_size
         self.transposed = transposed
-        self.window_attention = MultiHeadAttention(dim, transposed, num_heads)
+        self.window_attention = MultiHeadAttention(
+            dim,
+            transposed,
+            num_heads,
+            None if shared is None else shared.window_attention
+        )
         self.mlp = nn.Sequential(
             nn.Linear(dim, dim * 4),
-            nn.GELU(),
+            nn.GELU(approximate="tanh"),
             nn.Linear(dim * 4, dim)
         )
-        self.norm1 = nn.LayerNorm(dim)
-        self.norm2 = nn.LayerNorm(dim)
+        norm = RMSNorm if rms_norm else nn.LayerNorm
+        self.norm1 = norm(dim)
+        self.norm2 = norm(dim)
 
     def forward(self, x: Tensor) -> Tensor:
         _, _, H, W = x.shape
 
         if self.transposed:
-            x = x.unsqueeze(1)
+            x = spatial_flatten(x.unsqueeze(1))
         else:
-            x = window_partition(x, self.window_size)
-        x = spatial_flatten(x)
+            x = window_tokens(x, self.window_size)
 
-        x_residual = x
-        x = self.norm1(x)
-        x = x_residual + self.window_attention(x, x, x)
-        x = x + self.mlp(self.norm2(x))
+        h = self.norm1(x)
+        h = self.window_attention(h, h, h)
+        if residual_layer_norm is None:
+            x = x + h
+            h = self.norm2(x)
+        elif isinstance(self.norm2, RMSNorm):
+            # Residual add fused into the same pass as `norm2`
+            h, x = residual_rms_norm(h, x, self.norm2.weight, self.norm2.eps)
+        else:
+            h, x = residual_layer_norm(h, x, self.norm2.weight, self.norm2.bias, self.norm2.eps)
+        x = x + self.mlp(h)
 
         if self.transposed:
-            x = spatial_unflatten(x, H, W)
-            x = x.squeeze(1)
+            x = spatial_unflatten(x, H, W).squeeze(1)
         else:
-            x = spatial_unflatten(x, self.window_size, self.window_size)
-            x = window_unpartition(x, H, W)
+            x = window_untokens(x, H, W, self.window_size)
 
         return x
     
+class PairedAttentionBlock(nn.Sequential):
+    """
+    Window `AttentionBlock` followed by transposed `AttentionBlock`,
+    optionally sharing the same attention projections
+    - Input: (B, `dim`, H, W)
+    - Output: (B, `dim`, H, W)
+    """
+
+    def __init__(
+        self,
+        dim: int,
+        window_size: int = 8,
+        num_heads: int = 8,
+        share_projections: bool = False,
+        rms_norm: bool = False
+    ) -> None:
+        """
+        Parameters:
+        - `dim`: number of channels
+        - `window_size`: size of square window
+        - `num_heads`: number of attention heads
+        - `share_projections`: if `True`, both blocks use the same attention projections (default False)
+        - `rms_norm`: if `True`, both blocks use `RMSNorm` instead of `nn.LayerNorm` (default False)
+        """
+
+        window_block = AttentionBlock(dim, False, window_size, num_heads, rms_norm=rms_norm)
+        super().__init__(
+            window_block,
+            AttentionBlock(
+                dim,
+                True,
+                window_size,
+                num_heads,
+                window_block if share_projections else None,
+                rms_norm
+            )
+        )
+        self.share_projections = share_projections
+
+    def _load_from_state_dict(
+        self,
+        state_dict: dict,
+        prefix: str,
+        local_metadata: dict,
+        strict: bool,
+        missing_keys: list,
+        unexpected_keys: list,
+        error_msgs: list
+    ) -> None:
+        # Shared projections would silently keep whichever block is loaded last,
+        # so refuse checkpoints where the two blocks were trained separately
+        if self.share_projections:
+            window_prefix = f"{prefix}0.window_attention.project_"
+            for key in [key for key in state_dict if key.startswith(window_prefix)]:
+                paired_key = f"{prefix}1.{key[len(prefix) + 2:]}"
+                if paired_key in state_dict and not torch.equal(state_dict[key], state_dict[paired_key]):
+                    error_msgs.append(
+                        f"{key} and {paired_key} differ, "
+                        "this checkpoint was trained without share_projections"
+                    )
+
+        super()._load_from_state_dict(
+            state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs
+        )
+
+def enable_fused_window_attention(model: nn.Module) -> None:
+    """
+    Switches every `MultiHeadAttention` in `model` to the Triton window attention kernel,
+    which only runs for CUDA inference and falls back to SDPA otherwise or without Triton
+    """
+
+    for module in model.modules():
+        if isinstance(module, MultiHeadAttention):
+            module.fused_window_attention = True
+
+def compile_attention_blocks(model: nn.Module) -> None:
+    """
+    Compiles every `AttentionBlock` in `model` in place,
+    parameter names are unchanged so saved weights still load
+    """
+
+    for module in model.modules():
+        if isinstance(module, AttentionBlock):
+            module.compile(mode="max-autotune")
+
 class SR(nn.Module):
     """
     Sequence of `AttentionBlock` with pixel shuffle upsampling at the end
@@ -172,7 +312,11 @@ class SR(nn.Module):
             window_size: int,
             num_heads: tuple | list,
             in_channels: int = 3,
-            out_channels: int = 3
+            out_channels: int = 3,
+            share_projections: bool = False,
+            rms_norm: bool = False,
+            fused_window_attention: bool = False,
+            compile_blocks: bool = False
     ) -> None:
         """
         Parameters:
@@ -183,25 +327,52 @@ class SR(nn.Module):
         - `num_heads`: number of attention heads
         - `in_channels`: number of input channels (default 3)
         - `out_channels`: number of output channels (default 3)
+        - `share_projections`: if `True`, each window / transposed block pair shares its attention projections (default False)
+        - `rms_norm`: if `True`, attention blocks use `RMSNorm` instead of `nn.LayerNorm` (default False)
+        - `fused_window_attention`: if `True`, uses the Triton window attention kernel for CUDA inference (default False)
+        - `compile_blocks`: if `True`, compiles each `AttentionBlock` with `torch.compile` (default False)
         """
         
         super().__init__()
         self.layers = nn.Sequential(
             nn.Conv2d(in_channels, dim, kernel_size=3, padding=1),
             *[
-                nn.Sequential(
-                    AttentionBlock(dim, False, window_size, num_heads),
-                    AttentionBlock(dim, True, window_size, num_heads)
-                ) for _ in range(num_blocks)
+                PairedAttentionBlock(dim, window_size, num_heads, share_projections, rms_norm)
+                for _ in range(num_blocks)
             ],
             nn.Conv2d(dim, (factor ** 2) * out_channels, kernel_size=3, padding=1),
             nn.PixelShuffle(factor)
         )
+
+        # Fold the `+ 0.5` output shift into the last conv bias,
+        # pixel shuffle only moves channels around so this is exact
+        with torch.no_grad():
+            self.layers[-2].bias += 0.5
+
+        # Channels last convs are faster on tensor cores and make the token layout a free view
+        self.to(memory_format=torch.channels_last)
+
+        if fused_window_attention:
+            enable_fused_window_attention(self)
+
+        if compile_blocks:
+            compile_attention_blocks(self)
     
+    # Version 2 has the `+ 0.5` output shift folded into the last conv bias
+    _version = 2
+
+    def _load_from_state_dict(self, state_dict: dict, prefix: str, local_metadata: dict, *args) -> None:
+        version = local_metadata.get("version", None)
+        bias_key = f"{prefix}layers.{len(self.layers) - 2}.bias"
+        if (version is None or version < 2) and bias_key in state_dict:
+            warnings.warn(f"Folding the + 0.5 output shift into {bias_key} of an older checkpoint")
+            state_dict[bias_key] = state_dict[bias_key] + 0.5
+
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, *args)
+
     def forward(self, x: Tensor) -> Tensor:
-        x = x - 0.5
-        x = self.layers(x)
-        return x + 0.5
+        x = x.contiguous(memory_format=torch.channels_last) - 0.5
+        return self.layers(x)
     
 class Classifier(nn.Module):
     """
@@ -218,7 +389,11 @@ class Classifier(nn.Module):
         window_size: int,
         num_heads: int,
         num_classes: int,
-        in_channels: int = 3
+        in_channels: int = 3,
+        share_projections: bool = False,
+        rms_norm: bool = False,
+        fused_window_attention: bool = False,
+        compile_blocks: bool = False
     ) -> None:
         """
         Parameters:
@@ -228,28 +403,35 @@ class Classifier(nn.Module):
         - `num_heads`: number of attention heads
         - `in_channels`: number of input channels (default 3)
         - `out_channels`: number of output channels (default 3)
+        - `share_projections`: if `True`, each window / transposed block pair shares its attention projections (default False)
+        - `rms_norm`: if `True`, attention blocks use `RMSNorm` instead of `nn.LayerNorm` (default False)
+        - `fused_window_attention`: if `True`, uses the Triton window attention kernel for CUDA inference (default False)
+        - `compile_blocks`: if `True`, compiles each `AttentionBlock` with `torch.compile` (default False)
         """
         
         super().__init__()
 
-        self.blocks = nn.ModuleList([nn.Conv2d(in_channels, dims[0], kernel_size=3, padding=1)])
+        self.blocks = nn.Sequential(nn.Conv2d(in_channels, dims[0], kernel_size=3, padding=1))
         for i in range(len(groups)):
             if i > 0:
                 self.blocks.append(nn.Conv2d(dims[i - 1], dims[i], kernel_size=2, stride=2))
             for _ in range(groups[i]):
-                self.blocks += [
-                    AttentionBlock(dims[i], False, window_size // 2 ** i, num_heads),
-                    AttentionBlock(dims[i], True, window_size // 2 ** i, num_heads)
-                ]
-
-        self.blocks += [
-            nn.AdaptiveAvgPool2d(1),
-            nn.Flatten(),
-            nn.Linear(dims[-1], num_classes)
-        ]
+                self.blocks.append(
+                    PairedAttentionBlock(dims[i], window_size // 2 ** i, num_heads, share_projections, rms_norm)
+                )
+
+        self.head = nn.Linear(dims[-1], num_classes)
+
+        # Channels last for the same reasons as in `SR`
+        self.to(memory_format=torch.channels_last)
+
+        if fused_window_attention:
+            enable_fused_window_attention(self)
+
+        if compile_blocks:
+            compile_attention_blocks(self)
 
     def forward(self, x: Tensor) -> Tensor:
-        x = x - 0.5
-        for block in self.blocks:
-            x = block(x)
-        return x
\ No newline at end of file
+        # Global average pool as a single reduction
+        x = x.contiguous(memory_format=torch.channels_last) - 0.5
+        return self.head(self.blocks(x).mean((2, 3)))
\ No newline at end of file
@@ -0,0 +1,123 @@
+import torch
+import torch.nn.functional as F
+import triton
+import triton.language as tl
+from torch import Tensor
+
+# Longest window the kernel handles, the (L, L) score tile has to fit on chip
+MAX_WINDOW_LENGTH = 128
+
+# Feature dim chunk loaded per step, `tl.dot` needs at least 16
+CHUNK_DIM = 16
+
+
+@triton.jit
+def _window_attention_kernel(
+    q_ptr,
+    k_ptr,
+    v_ptr,
+    out_ptr,
+    seq_len,
+    head_dim,
+    scale,
+    BLOCK_L: tl.constexpr,
+    CHUNK_D: tl.constexpr,
+    INPUT_PRECISION: tl.constexpr
+):
+    """
+    Attention over one whole window per program, following Flash Window Attention:
+    the window is short enough for the full score tile to stay on chip,
+    so instead of tiling the sequence the feature dim is processed in chunks
+    """
+
+    # 64 bit offsets, (B * num_heads * L * head_dim) can exceed 2 ** 31
+    offset = tl.program_id(0).to(tl.int64) * seq_len * head_dim
+    rows = tl.arange(0, BLOCK_L)
+    cols = tl.arange(0, CHUNK_D)
+    row_mask = rows < seq_len
+
+    # S = Q x KT, accumulated over feature chunks
+    scores = tl.zeros((BLOCK_L, BLOCK_L), dtype=tl.float32)
+    for d in range(0, head_dim, CHUNK_D):
+        mask = row_mask[:, None] & (d + cols < head_dim)[None, :]
+        index = offset + rows[:, None] * head_dim + d + cols[None, :]
+        q = tl.load(q_ptr + index, mask=mask, other=0.0)
+        k = tl.load(k_ptr + index, mask=mask, other=0.0)
+        scores += tl.dot(q, tl.trans(k), input_precision=INPUT_PRECISION)
+
+    # Softmax over the whole row, padded keys are masked out
+    scores = tl.where(row_mask[None, :], scores * scale, float("-inf"))
+    scores = tl.exp(scores - tl.max(scores, axis=1)[:, None])
+    scores = scores / tl.sum(scores, axis=1)[:, None]
+
+    # O = P x V, one feature chunk at a time
+    for d in range(0, head_dim, CHUNK_D):
+        mask = row_mask[:, None] & (d + cols < head_dim)[None, :]
+        index = offset + rows[:, None] * head_dim + d + cols[None, :]
+        v = tl.load(v_ptr + index, mask=mask, other=0.0)
+        out = tl.dot(scores.to(v.dtype), v, input_precision=INPUT_PRECISION)
+        tl.store(out_ptr + index, out.to(out_ptr.dtype.element_ty), mask=mask)
+
+def flash_window_attention(q: Tensor, k: Tensor, v: Tensor, scale: float) -> Tensor:
+    """
+    Runs the fused window attention kernel, forward only
+    - Input: (B, L, head_dim)
+    - Output: (B, L, head_dim)
+    """
+
+    q, k, v = q.contiguous(), k.contiguous(), v.contiguous()
+    B, L, D = q.shape
+    out = torch.empty_like(q)
+
+    _window_attention_kernel[(B,)](
+        q, k, v, out,
+        L, D, scale,
+        BLOCK_L=max(16, triton.next_power_of_2(L)),
+        CHUNK_D=CHUNK_DIM,
+        # fp32 `tl.dot` defaults to TF32, ieee keeps fp32 inputs on par with SDPA
+        INPUT_PRECISION="ieee" if q.dtype == torch.float32 else "tf32"
+    )
+
+    return out
+
+def sdpa_window(q: Tensor, k: Tensor, v: Tensor, scale: float | None = None) -> Tensor:
+    """
+    Drop-in for `F.scaled_dot_product_attention` on short windows during inference,
+    falls back to it for CPU tensors, windows longer than `MAX_WINDOW_LENGTH`
+    or when gradients are needed, since SDPA keeps its softmax statistics for backward
+    - Input: (*, L, head_dim)
+    - Output: (*, L, head_dim)
+    """
+
+    L, D = q.shape[-2], q.shape[-1]
+    needs_grad = torch.is_grad_enabled() and any(t.requires_grad for t in (q, k, v))
+    if not q.is_cuda or L > MAX_WINDOW_LENGTH or needs_grad:
+        return F.scaled_dot_product_attention(q, k, v, scale=scale)
+
+    scale = D ** -0.5 if scale is None else scale
+    return flash_window_attention(
+        q.reshape(-1, L, D),
+        k.reshape(-1, L, D),
+        v.reshape(-1, L, D),
+        scale
+    ).view(q.shape)
+
+if __name__ == "__main__":
+    # Parity check against `F.scaled_dot_product_attention`,
+    # covers padded windows and head dims that are not a multiple of `CHUNK_DIM`
+    torch.manual_seed(0)
+    failures = 0
+    for dtype, tolerance in [(torch.float32, 1e-5), (torch.float16, 5e-3), (torch.bfloat16, 3e-2)]:
+        for window_size in [3, 4, 7, 8, 11]:
+            for head_dim in [8, 16, 24, 32, 64]:
+                L = window_size ** 2
+                q, k, v = torch.randn(3, 37, L, head_dim, device="cuda", dtype=dtype).unbind(0)
+                scale = head_dim ** -0.5
+                expected = F.scaled_dot_product_attention(q.float(), k.float(), v.float(), scale=scale)
+                error = (flash_window_attention(q, k, v, scale).float() - expected).abs().max().item()
+                failures += error >= tolerance
+                status = "ok" if error < tolerance else "FAILED"
+                print(f"{str(dtype):15s} L={L:<4d} head_dim={head_dim:<3d} max error {error:.2e} {status}")
+
+    if failures > 0:
+        raise SystemExit(f"{failures} configurations do not match F.scaled_dot_product_attention")
@@ -0,0 +1,184 @@
+import torch
+import torch.nn.functional as F
+import triton
+import triton.language as tl
+from torch import Tensor
+
+from .norm import rms_norm
+
+
+@triton.jit
+def _residual_layer_norm_kernel(
+    x_ptr,
+    residual_ptr,
+    weight_ptr,
+    bias_ptr,
+    out_ptr,
+    sum_ptr,
+    dim,
+    eps,
+    BLOCK_C: tl.constexpr
+):
+    """Adds one row of `x` and `residual`, writes the sum and its layer norm in a single pass"""
+
+    cols = tl.arange(0, BLOCK_C)
+    mask = cols < dim
+    # 64 bit offsets, (rows * dim) can exceed 2 ** 31
+    index = tl.program_id(0).to(tl.int64) * dim + cols
+
+    x = tl.load(x_ptr + index, mask=mask, other=0.0).to(tl.float32)
+    x += tl.load(residual_ptr + index, mask=mask, other=0.0).to(tl.float32)
+
+    # Normalize the sum as stored, so the result matches `layer_norm(x + residual)`
+    x = x.to(sum_ptr.dtype.element_ty)
+    tl.store(sum_ptr + index, x, mask=mask)
+    x = x.to(tl.float32)
+
+    mean = tl.sum(x, axis=0) / dim
+    x = tl.where(mask, x - mean, 0.0)
+    var = tl.sum(x * x, axis=0) / dim
+
+    weight = tl.load(weight_ptr + cols, mask=mask, other=0.0).to(tl.float32)
+    bias = tl.load(bias_ptr + cols, mask=mask, other=0.0).to(tl.float32)
+    out = x * tl.rsqrt(var + eps) * weight + bias
+    tl.store(out_ptr + index, out.to(out_ptr.dtype.element_ty), mask=mask)
+
+@triton.jit
+def _residual_rms_norm_kernel(
+    x_ptr,
+    residual_ptr,
+    weight_ptr,
+    out_ptr,
+    sum_ptr,
+    dim,
+    eps,
+    BLOCK_C: tl.constexpr
+):
+    """Adds one row of `x` and `residual`, writes the sum and its RMS norm in a single pass"""
+
+    cols = tl.arange(0, BLOCK_C)
+    mask = cols < dim
+    # 64 bit offsets, (rows * dim) can exceed 2 ** 31
+    index = tl.program_id(0).to(tl.int64) * dim + cols
+
+    x = tl.load(x_ptr + index, mask=mask, other=0.0).to(tl.float32)
+    x += tl.load(residual_ptr + index, mask=mask, other=0.0).to(tl.float32)
+
+    # Normalize the sum as stored, so the result matches `rms_norm(x + residual)`
+    x = x.to(sum_ptr.dtype.element_ty)
+    tl.store(sum_ptr + index, x, mask=mask)
+    x = x.to(tl.float32)
+
+    mean_square = tl.sum(x * x, axis=0) / dim
+    weight = tl.load(weight_ptr + cols, mask=mask, other=0.0).to(tl.float32)
+    out = x * tl.rsqrt(mean_square + eps) * weight
+    tl.store(out_ptr + index, out.to(out_ptr.dtype.element_ty), mask=mask)
+
+class FusedResidualLayerNorm(torch.autograd.Function):
+    """
+    Fused residual add and layer norm, forward runs the Triton kernel,
+    backward recomputes the layer norm in fp32 with `F.layer_norm`
+    - Input: (*, C), (*, C)
+    - Output: (*, C), (*, C)
+    """
+
+    @staticmethod
+    def forward(ctx, x: Tensor, residual: Tensor, weight: Tensor, bias: Tensor, eps: float) -> tuple:
+        x, residual = x.contiguous(), residual.contiguous()
+        C = x.shape[-1]
+        summed = torch.empty(x.shape, dtype=torch.promote_types(x.dtype, residual.dtype), device=x.device)
+        out = torch.empty_like(summed)
+
+        _residual_layer_norm_kernel[(x.numel() // C,)](
+            x, residual, weight, bias, out, summed,
+            C, eps,
+            BLOCK_C=triton.next_power_of_2(C)
+        )
+
+        ctx.save_for_backward(summed, weight, bias)
+        ctx.eps = eps
+        return out, summed
+
+    @staticmethod
+    def backward(ctx, grad_out: Tensor, grad_sum: Tensor) -> tuple:
+        summed, weight, bias = ctx.saved_tensors
+        with torch.enable_grad():
+            summed, weight, bias = [t.detach().float().requires_grad_() for t in (summed, weight, bias)]
+            out = F.layer_norm(summed, summed.shape[-1:], weight, bias, ctx.eps)
+        grad_x, grad_weight, grad_bias = torch.autograd.grad(out, (summed, weight, bias), grad_out.float())
+
+        if grad_sum is not None:
+            grad_x = grad_x + grad_sum
+        return grad_x, grad_x, grad_weight, grad_bias, None
+
+class FusedResidualRMSNorm(torch.autograd.Function):
+    """
+    Fused residual add and RMS norm, forward runs the Triton kernel,
+    backward recomputes the RMS norm in fp32 with `rms_norm`
+    - Input: (*, C), (*, C)
+    - Output: (*, C), (*, C)
+    """
+
+    @staticmethod
+    def forward(ctx, x: Tensor, residual: Tensor, weight: Tensor, eps: float) -> tuple:
+        x, residual = x.contiguous(), residual.contiguous()
+        C = x.shape[-1]
+        summed = torch.empty(x.shape, dtype=torch.promote_types(x.dtype, residual.dtype), device=x.device)
+        out = torch.empty_like(summed)
+
+        _residual_rms_norm_kernel[(x.numel() // C,)](
+            x, residual, weight, out, summed,
+            C, eps,
+            BLOCK_C=triton.next_power_of_2(C)
+        )
+
+        ctx.save_for_backward(summed, weight)
+        ctx.eps = eps
+        return out, summed
+
+    @staticmethod
+    def backward(ctx, grad_out: Tensor, grad_sum: Tensor) -> tuple:
+        summed, weight = ctx.saved_tensors
+        with torch.enable_grad():
+            summed, weight = [t.detach().float().requires_grad_() for t in (summed, weight)]
+            out = rms_norm(summed, weight, ctx.eps)
+        grad_x, grad_weight = torch.autograd.grad(out, (summed, weight), grad_out.float())
+
+        if grad_sum is not None:
+            grad_x = grad_x + grad_sum
+        return grad_x, grad_x, grad_weight, None
+
+def residual_layer_norm(
+    x: Tensor,
+    residual: Tensor,
+    weight: Tensor,
+    bias: Tensor,
+    eps: float = 1e-5
+) -> tuple[Tensor, Tensor]:
+    """
+    Returns `(layer_norm(x + residual), x + residual)`,
+    computed by one fused kernel on CUDA tensors
+    """
+
+    if not x.is_cuda:
+        summed = x + residual
+        return F.layer_norm(summed, summed.shape[-1:], weight, bias, eps), summed
+
+    return FusedResidualLayerNorm.apply(x, residual, weight, bias, eps)
+
+def residual_rms_norm(
+    x: Tensor,
+    residual: Tensor,
+    weight: Tensor,
+    eps: float = 1e-6
+) -> tuple[Tensor, Tensor]:
+    """
+    Returns `(rms_norm(x + residual), x + residual)`,
+    computed by one fused kernel on CUDA tensors
+    """
+
+    if not x.is_cuda:
+        summed = x + residual
+        return rms_norm(summed, weight, eps), summed
+
+    return FusedResidualRMSNorm.apply(x, residual, weight, eps)
@@ -0,0 +1,55 @@
+import torch
+from torch import Tensor, nn
+
+
+def rms_norm(x: Tensor, weight: Tensor, eps: float) -> Tensor:
+    """
+    Normalizes the last dim of `x` by its root mean square and scales by `weight`,
+    computed in fp32 and returned in the dtype of `x`
+    """
+
+    y = x.float()
+    y = y * torch.rsqrt(y.pow(2).mean(-1, keepdim=True) + eps) * weight.float()
+    return y.to(x.dtype)
+
+class RMSNorm(nn.Module):
+    """
+    Normalizes the last dim by its root mean square, see `rms_norm`
+    - Input: (*, `dim`)
+    - Output: (*, `dim`)
+    """
+
+    def __init__(self, dim: int, eps: float = 1e-6) -> None:
+        """
+        Parameters:
+        - `dim`: number of channels
+        - `eps`: added to the mean square for numerical stability (default 1e-6)
+        """
+
+        super().__init__()
+        self.eps = eps
+        self.weight = nn.Parameter(torch.ones(dim))
+
+    def _load_from_state_dict(
+        self,
+        state_dict: dict,
+        prefix: str,
+        local_metadata: dict,
+        strict: bool,
+        missing_keys: list,
+        unexpected_keys: list,
+        error_msgs: list
+    ) -> None:
+        # `nn.LayerNorm` checkpoints also have a bias, the weight alone would silently load but not match
+        if f"{prefix}bias" in state_dict:
+            error_msgs.append(
+                f"{prefix}bias is a LayerNorm parameter, "
+                "this checkpoint was trained without rms_norm"
+            )
+
+        super()._load_from_state_dict(
+            state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs
+        )
+
+    def forward(self, x: Tensor) -> Tensor:
+        return rms_norm(x, self.weight, self.eps)